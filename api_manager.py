@@ -1,7 +1,8 @@
 import time
 import threading
+import numpy as np
+from collections import deque
 from datetime import datetime, timedelta
-from pytz import timezone
 from typing import Dict
 from ibapi.wrapper import EWrapper
 from ibapi.client import EClient
@@ -9,6 +10,25 @@ from ibapi.contract import Contract
 from ibapi.common import BarData
 
 
+# How long received historical data is considered fresh before the
+# next portfolio update re-requests it
+HISTORICAL_DATA_TTL = timedelta(hours=4)
+
+# How long to wait before re-requesting historical data that failed, 
+# to stay within IBKR's pacing limits
+HISTORICAL_DATA_RETRY = timedelta(minutes=10)
+
+# How long to wait for a historical data request to end before it is 
+# considered lost and may be sent again
+HISTORICAL_DATA_TIMEOUT = timedelta(minutes=2)
+
+# Market index whose history is requested alongside the portfolio
+MARKET_SYMBOL = "SPY"
+
+# Seconds between background checks for expired historical data
+POLL_INTERVAL = 30
+
+
 class IBKRApp(EWrapper, EClient):
     """
     A class to interface with IBKR and retrieve live portfolio updates.
@@ -19,27 +39,47 @@ class IBKRApp(EWrapper, EClient):
         Dictionary storing live portfolio updates, indexed by stock symbol.
     thread : threading.Thread or None
         Thread for running the IBKR app.
+    poll_thread : threading.Thread or None
+        Thread re-requesting expired historical data in the background.
     lock : threading.Lock
         Lock for ensuring thread safety when accessing `portfolio_updates`.
+    connected_event : threading.Event
+        Event set while the connection to TWS/IB Gateway is established.
+    ready : threading.Event
+        Event set once the account download and all outstanding 
+        historical data requests have completed.
     """
 
     def __init__(self):
         EClient.__init__(self, self)
         self.is_connected = False
+        self.connected_event = threading.Event()
+        self.ready = threading.Event()
+        self.account_download_done = False
 
         self.thread = None
+        self.poll_thread = None
+        self.stop_event = threading.Event()
         self.lock = threading.RLock()
 
         self.managed_accounts = []
         
-        self.live_portfolio = {}
+        # Live portfolio stored as parallel arrays, indexed by position
+        self.portfolio_symbols = []
+        self.portfolio_index = {}
+        self.portfolio_currencies = []
+        self.portfolio_contracts = []
+        self.portfolio_market_values = np.empty(0)
         self.net_liquidation = 0
 
         self.currency_rates = {}
         self.forex_data_requests = {}
         
         self.historical_data = {}
+        self.historical_data_incoming = deque()
+        self.historical_data_buffer = {}
         self.historical_data_requests = {}
+        self.historical_data_pending = {}
         self.historical_data_ttl = {}
         
         self.reqId_counter = 0
@@ -51,13 +91,14 @@ class IBKRApp(EWrapper, EClient):
         This method is part of the EWrapper and is automatically invoked when 
         the connection to the TWS/IB Gateway has been successfully established.
 
-        Sets the `is_connected` attribute to True.
+        Sets the `is_connected` attribute to True and sets `connected_event`.
 
         Returns
         -------
         None
         """
         self.is_connected = True
+        self.connected_event.set()
 
     def connectionClosed(self):
         """
@@ -66,13 +107,19 @@ class IBKRApp(EWrapper, EClient):
         This method is part of the EWrapper and is automatically invoked when 
         the connection to the TWS/IB Gateway is lost or manually closed.
 
-        Sets the `is_connected` attribute to False.
+        Sets the `is_connected` attribute to False and clears `connected_event`. 
+        Outstanding historical data requests will not end, so they are dropped.
 
         Returns
         -------
         None
         """
         self.is_connected = False
+        self.connected_event.clear()
+        with self.lock:
+            self.historical_data_requests.clear()
+            self.historical_data_pending.clear()
+            self.historical_data_buffer.clear()
 
     def managedAccounts(self, accountsList: str):
         """
@@ -86,6 +133,18 @@ class IBKRApp(EWrapper, EClient):
         self.managed_accounts = accountsList.split(',')
         for account in self.managed_accounts:
             self.reqAccountUpdates(True, account)
+
+    def nextValidId(self, orderId):
+        """
+        Callback method that is called when the next valid order ID is 
+        received, once the connection is ready to accept requests.
+
+        Parameters
+        ----------
+        orderId : int
+            The next valid order ID.
+        """
+        self.request_market_historical_data()
     
     def updatePortfolio(self, contract, position, marketPrice, marketValue,
                         averageCost, unrealizedPNL, realizedPNL, accountName):
@@ -113,15 +172,24 @@ class IBKRApp(EWrapper, EClient):
         """
         if contract.secType == "STK":
             with self.lock:
-                self.live_portfolio[contract.symbol] = {
-                    'market_value': marketValue,
-                    'currency': contract.currency,
-                }     
+                index = self.portfolio_index.get(contract.symbol, None)
+                if index is None:
+                    self.portfolio_index[contract.symbol] = len(self.portfolio_symbols)
+                    self.portfolio_symbols.append(contract.symbol)
+                    self.portfolio_currencies.append(contract.currency)
+                    self.portfolio_contracts.append(contract)
+                    self.portfolio_market_values = np.append(
+                        self.portfolio_market_values, marketValue)
+                else:
+                    self.portfolio_currencies[index] = contract.currency
+                    self.portfolio_contracts[index] = contract
+                    self.portfolio_market_values[index] = marketValue
 
         if contract.currency != "USD":
             self.request_forex_data(contract.currency)        
         
         self.request_historical_data(contract)
+        self.request_market_historical_data()
     
     def updateAccountValue(self, key, val, currency, accountName):
         """
@@ -142,10 +210,27 @@ class IBKRApp(EWrapper, EClient):
             if key == "NetLiquidation":
                 self.net_liquidation = float(val)
 
+    def accountDownloadEnd(self, accountName):
+        """
+        Callback method that is called once the initial portfolio and 
+        account values have been received.
+
+        Parameters
+        ----------
+        accountName : str
+            The account name.
+        """
+        with self.lock:
+            self.account_download_done = True
+            self._check_ready()
+
     def historicalData(self, reqId, bar: BarData):
         """
         Callback method to handle the received historical data for a stock.
         It is invoked when the historical data for a stock is received.
+
+        Bars are queued without taking the lock (deque appends are 
+        thread-safe) and merged in one batch at the end of the request.
     
         Parameters
         ----------
@@ -154,14 +239,92 @@ class IBKRApp(EWrapper, EClient):
         bar : BarData
             The bar data containing the historical data for the stock.
         """
+        self.historical_data_incoming.append((reqId, bar.date, bar.close))
+
+    def _drain_historical_data(self):
+        """
+        Merge all queued bars into the per-request buffers. Must be 
+        called with the lock held.
+        """
+        while self.historical_data_incoming:
+            reqId, date, close = self.historical_data_incoming.popleft()
+            if reqId not in self.historical_data_requests:
+                continue
+            if reqId not in self.historical_data_buffer:
+                self.historical_data_buffer[reqId] = {}
+            self.historical_data_buffer[reqId][date] = close
+
+    def historicalDataEnd(self, reqId, start, end):
+        """
+        Callback method that is called once all bars of a historical
+        data request have been received. The buffered bars replace any
+        expired data for the stock, and the expiry is stamped once per 
+        request rather than once per bar.
+
+        Parameters
+        ----------
+        reqId : int
+            The request ID associated with the historical data request.
+        start : str
+            The start date of the received bars.
+        end : str
+            The end date of the received bars.
+        """
         with self.lock:
-            symbol = self.historical_data_requests.get(reqId, None)
-            if symbol is None:
-                return
-            if symbol not in self.historical_data:
-                self.historical_data[symbol] = {}
-            self.historical_data[symbol][bar.date] = bar.close
-            self.historical_data_ttl[symbol] = datetime.now() + timedelta(hours=4)
+            self._drain_historical_data()
+            symbol = self.historical_data_requests.pop(reqId, None)
+            bars = self.historical_data_buffer.pop(reqId, None)
+            self.historical_data_pending.pop(symbol, None)
+            if symbol is not None and bars:
+                self.historical_data[symbol] = bars
+                self.historical_data_ttl[symbol] = datetime.now() + HISTORICAL_DATA_TTL
+            self._check_ready()
+
+    def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+        """
+        Callback for errors and notifications. A failed historical data
+        request will never end, so it is dropped from the outstanding
+        requests to avoid holding back the `ready` event, and is not 
+        retried until `HISTORICAL_DATA_RETRY` has passed. Warnings (codes 
+        2100 to 2199) do not end a request, so they are only logged.
+        """
+        EWrapper.error(self, reqId, errorCode, errorString, advancedOrderRejectJson)
+        if 2100 <= errorCode < 2200:
+            return
+        with self.lock:
+            symbol = self.historical_data_requests.pop(reqId, None)
+            if symbol is not None:
+                self.historical_data_pending.pop(symbol, None)
+                self.historical_data_buffer.pop(reqId, None)
+                self.historical_data_ttl[symbol] = datetime.now() + HISTORICAL_DATA_RETRY
+                self._check_ready()
+
+    def _expire_historical_data_requests(self):
+        """
+        Drop historical data requests that have received neither their 
+        end nor an error within `HISTORICAL_DATA_TIMEOUT`, so that they 
+        can be sent again and do not hold back the `ready` event. Must 
+        be called with the lock held.
+        """
+        expiry = datetime.now() - HISTORICAL_DATA_TIMEOUT
+        expired = [
+            (symbol, reqId) for symbol, (reqId, sent) in self.historical_data_pending.items()
+            if sent < expiry
+        ]
+        for symbol, reqId in expired:
+            del self.historical_data_pending[symbol]
+            self.historical_data_requests.pop(reqId, None)
+            self.historical_data_buffer.pop(reqId, None)
+        if expired:
+            self._check_ready()
+
+    def _check_ready(self):
+        """
+        Set the `ready` event once the account download has completed 
+        and no historical data requests are outstanding.
+        """
+        if self.account_download_done and not self.historical_data_requests:
+            self.ready.set()
 
     def request_historical_data(self, contract):
         """
@@ -179,12 +342,18 @@ class IBKRApp(EWrapper, EClient):
         WHAT_TO_SHOW = "TRADES"
 
         with self.lock:
+            # Skip if a request is already in flight, the data is fresh or
+            # a previous request failed recently
+            self._expire_historical_data_requests()
+            if contract.symbol in self.historical_data_pending:
+                return
             if contract.symbol in self.historical_data_ttl and \
                 datetime.now() < self.historical_data_ttl[contract.symbol]:
                 return
             self.reqId_counter += 1
             reqId = self.reqId_counter
             self.historical_data_requests[reqId] = contract.symbol
+            self.historical_data_pending[contract.symbol] = (reqId, datetime.now())
         
         self.reqHistoricalData(
             reqId=reqId,
@@ -199,6 +368,19 @@ class IBKRApp(EWrapper, EClient):
             chartOptions=[],
         )
     
+    def request_market_historical_data(self):
+        """
+        Request the historical data for the market index (SPY), used to
+        calculate beta. Shares the expiry and de-duplication of the 
+        portfolio's historical data requests.
+        """
+        contract = Contract()
+        contract.symbol = MARKET_SYMBOL
+        contract.secType = "STK"
+        contract.currency = "USD"
+
+        self.request_historical_data(contract)
+    
     def request_forex_data(self, currency):
         """
         Request real-time forex data for currency conversion.
@@ -210,6 +392,9 @@ class IBKRApp(EWrapper, EClient):
         forex_contract.currency = "USD"
         
         with self.lock:
+            # Market data is streamed, so one subscription per currency suffices
+            if currency in self.forex_data_requests.values():
+                return
             self.reqId_counter += 1
             reqId = self.reqId_counter
             self.forex_data_requests[reqId] = currency
@@ -236,22 +421,51 @@ class IBKRApp(EWrapper, EClient):
         except Exception as e:
             print(f"Error connecting or running the IBKR App: {e}")
 
+    def poll_historical_data(self):
+        """
+        Periodically re-request the historical data of the portfolio and 
+        the market, so that expired data is refreshed in the background 
+        rather than on the Streamlit render thread. Requests for data that 
+        is still fresh, already in flight or recently failed are skipped.
+        """
+        while not self.stop_event.wait(POLL_INTERVAL):
+            if not self.is_connected:
+                continue
+            
+            # Reuse the contracts received from IBKR, which identify the 
+            # instrument unambiguously (conId, primary exchange)
+            with self.lock:
+                contracts = list(self.portfolio_contracts)
+            
+            for contract in contracts:
+                self.request_historical_data(contract)
+            self.request_market_historical_data()
+
     def start_thread(self):
         """
-        Start the data retrieval in a separate thread.
+        Start the data retrieval in a separate thread, along with 
+        the background thread refreshing historical data.
         """
         if not self.thread or not self.thread.is_alive():
             self.thread = threading.Thread(target=self.run_app)
             self.thread.start()
+        if not self.poll_thread or not self.poll_thread.is_alive():
+            self.stop_event.clear()
+            self.poll_thread = threading.Thread(
+                target=self.poll_historical_data, daemon=True)
+            self.poll_thread.start()
 
     def stop_thread(self):
         """
-        Stop the IBKR connection and the associated thread.
+        Stop the IBKR connection and the associated threads.
         """
+        self.stop_event.set()
         self.reqAccountUpdates(False, "")
         self.disconnect()
         if self.thread and self.thread.is_alive():
             self.thread.join()
+        if self.poll_thread and self.poll_thread.is_alive():
+            self.poll_thread.join()
 
     def get_live_portfolio(self):
         """
@@ -264,16 +478,18 @@ class IBKRApp(EWrapper, EClient):
             stock symbol.
         """       
         with self.lock:
-            if not self.live_portfolio:
+            if not self.portfolio_symbols:
                 raise ValueError("No portfolio data received from the API yet.")
+            if not self.net_liquidation:
+                raise ValueError("No net liquidation value received from the API yet.")
             
-            weights = {
-                stock: (stock_details['market_value'] * self.currency_rates.get(stock_details['currency'], 1)) /
-                        (self.net_liquidation)
-                for stock, stock_details in self.live_portfolio.items()
-            }
+            rates = np.array([
+                self.currency_rates.get(currency, 1) 
+                for currency in self.portfolio_currencies
+            ])
+            weights = self.portfolio_market_values * rates / self.net_liquidation
             
-        return weights
+            return dict(zip(self.portfolio_symbols, weights.tolist()))
 
     def get_historical_data(self):
         """
@@ -294,169 +510,34 @@ class IBKRApp(EWrapper, EClient):
             if not self.historical_data:
                 raise ValueError("No historical data received from the API yet.")
             return self.historical_data.copy()
-            
-
-class IBKRAppSPY(EClient, EWrapper):
-    """
-    A class to retrieve historical closing prices for SPY over the last 
-    90 days using the IBKR API.
-
-    Attributes
-    ----------
-    historical_data : dict
-        Dictionary to store the historical closing prices for SPY.
-    lock : threading.Lock
-        Lock for ensuring thread safety when accessing shared resources.
-    thread : threading.Thread or None
-        Thread for running the IBKRAppSPY.
-    data_retrieved : threading.Event
-        Event to signal when the historical data has been retrieved.
-    """
-
-    def __init__(self):
-        EWrapper.__init__(self)
-        EClient.__init__(self, wrapper=self)
-        self.is_connected = False
-        
-        self.historical_data = {}
-        
-        self.lock = threading.RLock()
-        self.thread = None
-
-    def connectAck(self):
-        """
-        Callback method that is called when a connection to the server is acknowledged.
-
-        This method is part of the EWrapper and is automatically invoked when 
-        the connection to the TWS/IB Gateway has been successfully established.
-
-        Sets the `is_connected` attribute to True.
-
-        Returns
-        -------
-        None
-        """
-        self.is_connected = True
-
-    def connectionClosed(self):
-        """
-        Callback method that is called when the connection to the server is closed.
-
-        This method is part of the EWrapper and is automatically invoked when 
-        the connection to the TWS/IB Gateway is lost or manually closed.
-
-        Sets the `is_connected` attribute to False.
-
-        Returns
-        -------
-        None
-        """
-        self.is_connected = False
-    
-    def nextValidId(self, orderId):
-        """
-        Callback method that is called when the next valid order ID is received.
-        """
-        self.request_historical_data()
-
-    def historicalData(self, reqId, bar):
-        """
-        Callback method to populate the historical_data dictionary 
-        with the closing prices.
-        """
-        with self.lock:
-            self.historical_data[bar.date] = bar.close
 
-    def is_time_to_fetch_data(self):
-        """
-        Check if the current time is 4:30pm ET.
+    def get_historical_data_spy(self):
         """
-        et = timezone('US/Eastern')
-        current_et_time = datetime.now(et)
-        target_et_time = current_et_time.replace(hour=16, minute=30, second=0, microsecond=0)
-        
-        # Window of a few minutes for fetching the data
-        start_time = target_et_time - timedelta(minutes=10)
-        end_time = target_et_time + timedelta(minutes=10)
-        
-        return start_time <= current_et_time <= end_time
+        Retrieve the historical closing prices of the market index (SPY).
+        The bars of a request are replaced as a whole rather than updated
+        in place, so the returned dictionary is not copied.
     
-    def request_historical_data(self):
-        """
-        Send historical data requests for SPY.
-        """
-        with self.lock:
-            if not self.is_time_to_fetch_data() and self.historical_data:
-                return
-        
-        contract = Contract()
-        contract.symbol = "SPY"
-        contract.secType = "STK"
-        contract.exchange = "SMART"
-        contract.currency = "USD"
-            
-        self.reqHistoricalData(
-            reqId=1,
-            contract=contract,
-            endDateTime="",
-            durationStr="90 D",
-            barSizeSetting="1 day",
-            whatToShow="TRADES",
-            useRTH=0,
-            formatDate=1,
-            keepUpToDate=False,
-            chartOptions=[]
-        )
-
-    def run_app(self):
-        """
-        Connect and run the app. Initializes connection with IBKR.
-        """
-        try:
-            self.connect("localhost", 7497, clientId=1)
-            self.run()
-        except Exception as e:
-            print(f"Error connecting or running the IBKR_SPY_HistoricalData: {e}")
-
-    def start_thread(self):
-        """
-        Start the data retrieval in a separate thread.
-        """
-        if not self.thread or not self.thread.is_alive():
-            self.thread = threading.Thread(target=self.run_app)
-            self.thread.start()
-
-    def stop_thread(self):
-        """
-        Stop the IBKR connection and the associated thread.
-        """
-        self.disconnect()
-        if self.thread and self.thread.is_alive():
-            self.thread.join()
-
-    def get_historical_data(self):
-        """
-        Returns the historical_data dictionary.
-
         Returns
         -------
         dict
-            Dictionary with dates as keys and closing prices as values.
+            A dictionary of dates to historical closing prices.
+    
+        Raises
+        ------
+        ValueError
+            If no market historical data has been received from the API yet.
         """
         with self.lock:
-            if not self.historical_data:
-                raise ValueError("No SPY historical data received from the API yet.")
-            return self.historical_data.copy()
-
+            if MARKET_SYMBOL not in self.historical_data:
+                raise ValueError("No market historical data received from the API yet.")
+            return self.historical_data[MARKET_SYMBOL]
+            
 
 def test():
     import pandas as pd
     
     app = IBKRApp()
     app.start_thread()
-
-    spy_app = IBKRAppSPY()
-    spy_app.start_thread()
     
     try:
         # Give the app some time to connect and start fetching updates
@@ -467,7 +548,7 @@ def test():
         historical_data = app.get_historical_data()
         
         # Get SPY data
-        spy_historical_data = spy_app.get_historical_data()
+        spy_historical_data = app.get_historical_data_spy()
         
         print("Live Portfolio Updates:")
         print(portfolio)
@@ -480,7 +561,6 @@ def test():
 
     finally:
         app.stop_thread()
-        spy_app.stop_thread()
 
 
 if __name__ == "__main__":
@@ -1,56 +1,202 @@
 import time
+import functools
 import numpy as np
-import pandas as pd
+from numba import njit
 import streamlit as st
 from datetime import datetime, timedelta
 
 
-def calculate_portfolio_volatility(portfolio_weights, portfolio_histories):
+def _price_matrix(histories, tickers):
     """
-    Calculates the portfolio volatility given a portfolio 
-    of stocks, weights and their historical prices.
+    Aligns the historical prices of the given tickers on a common,
+    sorted set of dates.
+
+    Prices missing on a date are forward-filled from the previous 
+    date, so that returns are computed over the gap.
+
+    Histories are expected in chronological order, as received from 
+    IBKR. When every ticker has the same dates (the usual case), the 
+    prices are stacked directly without merging or sorting dates.
 
     Parameters
     ----------
-    portfolio_weights : dict
-        A dictionary containing stock tickers as keys 
-        and their corresponding portfolio weights as values.
-    portfolio_histories : dict
-        A dictionary containing stock tickers as keys 
-        and their corresponding historical prices as values.
+    histories : dict
+        A dictionary containing stock tickers as keys and 
+        dictionaries of date to price as values.
+    tickers : list
+        The tickers to include, in column order.
 
     Returns
     -------
-    float
-        The portfolio volatility. Returns np.nan if historical 
-        prices cannot be retrieved or if the portfolio is empty.
+    tuple of (list, np.ndarray)
+        The sorted dates, and a (dates, tickers) array of prices.
     """
+    dates = list(histories[tickers[0]])
+    if all(list(histories[ticker]) == dates for ticker in tickers[1:]):
+        prices = np.column_stack([
+            np.fromiter(histories[ticker].values(), dtype=float, count=len(dates))
+            for ticker in tickers
+        ])
+        return dates, prices
 
-    # Check if the portfolio is empty
-    if not portfolio_weights:
-        st.warning("The portfolio is empty. Unable to calculate volatility.")
-        return np.nan
+    dates = sorted(set().union(*(histories[ticker] for ticker in tickers)))
+    date_positions = {date: i for i, date in enumerate(dates)}
 
-    # Format the weights and historical prices 
-    weights = np.array(list(portfolio_weights.values()))
-    historical_prices = pd.DataFrame(portfolio_histories).sort_index()
+    prices = np.full((len(dates), len(tickers)), np.nan)
+    for column, ticker in enumerate(tickers):
+        for date, price in histories[ticker].items():
+            prices[date_positions[date], column] = price
+
+    for row in range(1, len(dates)):
+        missing = np.isnan(prices[row])
+        prices[row, missing] = prices[row - 1, missing]
+
+    return dates, prices
+
+
+def _market_returns(market_history, dates):
+    """
+    Calculates the market log returns, aligned with the returns of 
+    prices on the given dates, and the variance of the market returns.
+
+    Parameters
+    ----------
+    market_history : dict
+        A dictionary of dates to closing prices of the market (SPY), 
+        in chronological order.
+    dates : list
+        The dates of the aligned stock prices.
 
-    # Calculate the returns
-    returns = historical_prices.pct_change()
+    Returns
+    -------
+    tuple of (np.ndarray, float)
+        The market returns ending on each of `dates[1:]` (NaN where 
+        the market has no return), and the market variance.
+    """
+    market_dates = list(market_history)
+    market_historical_prices = np.fromiter(
+        market_history.values(), dtype=np.float64, count=len(market_dates))
 
-    # Calculate the covariance matrix
-    cov_matrix = returns.cov() * 252  # We multiply by 252 to annualize the covariance
+    market_returns = np.diff(np.log(market_historical_prices))
+    market_variance = np.var(market_returns, ddof=1)
 
-    # Calculate the portfolio volatility
-    portfolio_volatility = np.sqrt(np.dot(weights.T, np.dot(cov_matrix, weights)))
+    # The market usually trades on the same dates as the stocks, in 
+    # which case its returns are already aligned
+    if market_dates == dates:
+        return market_returns, market_variance
 
-    return portfolio_volatility
+    market_returns_by_date = dict(zip(market_dates[1:], market_returns))
+    market_returns_aligned = np.array(
+        [market_returns_by_date.get(date, np.nan) for date in dates[1:]]
+    )
 
+    return market_returns_aligned, market_variance
 
-def calculate_portfolio_beta(portfolio_weights, portfolio_histories, market_history):
+
+@njit(cache=True)
+def _pairwise_covariance(x, y):
     """
-    Calculates the portfolio beta given a portfolio
-    of stocks and weights.
+    Calculates the covariance between every column of `x` and every 
+    column of `y`, using for each pair only the rows where both 
+    values are available.
+
+    Compiled with numba, so the NaN masking, means and products are 
+    fused into a single loop per pair without temporary arrays.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        A (T, N) array of observations, may contain NaN.
+    y : np.ndarray
+        A (T, M) array of observations, may contain NaN.
+
+    Returns
+    -------
+    np.ndarray
+        The (N, M) covariance matrix.
+    """
+    n_rows = x.shape[0]
+    cov = np.empty((x.shape[1], y.shape[1]))
+
+    for i in range(x.shape[1]):
+        for j in range(y.shape[1]):
+            count = 0
+            x_sum = 0.0
+            y_sum = 0.0
+            for row in range(n_rows):
+                if not (np.isnan(x[row, i]) or np.isnan(y[row, j])):
+                    count += 1
+                    x_sum += x[row, i]
+                    y_sum += y[row, j]
+
+            if count < 2:
+                cov[i, j] = np.nan
+                continue
+
+            x_mean = x_sum / count
+            y_mean = y_sum / count
+            total = 0.0
+            for row in range(n_rows):
+                if not (np.isnan(x[row, i]) or np.isnan(y[row, j])):
+                    total += (x[row, i] - x_mean) * (y[row, j] - y_mean)
+            cov[i, j] = total / (count - 1)
+
+    return cov
+
+
+@functools.lru_cache(maxsize=32)
+def _return_statistics(prices_bytes, market_returns_bytes, n_tickers, market_variance):
+    """
+    Calculates the annualized covariance matrix of the stock returns and 
+    the beta of each stock from the raw bytes of the aligned price array 
+    and market returns.
+
+    Neither depends on the weights, so they are memoized on the byte 
+    contents and reused by every rerun until new prices are received, 
+    while weight changes only repeat the reduction over groups. The 
+    returned arrays are read-only, as they are shared between calls.
+
+    Parameters
+    ----------
+    prices_bytes : bytes
+        The (dates, tickers) float64 price array from `_price_matrix`.
+    market_returns_bytes : bytes
+        The float64 market returns, aligned with the stock returns.
+    n_tickers : int
+        The number of tickers (columns) in the price array.
+    market_variance : float
+        The variance of the market returns.
+
+    Returns
+    -------
+    tuple of (np.ndarray, np.ndarray)
+        The (tickers, tickers) covariance matrix, and the beta of each stock.
+    """
+    historical_prices = np.frombuffer(prices_bytes).reshape(-1, n_tickers)
+    market_returns = np.frombuffer(market_returns_bytes)
+
+    # Calculate the log returns
+    returns = np.diff(np.log(historical_prices), axis=0)
+
+    # Calculate the covariance matrix and the beta of each stock
+    cov_matrix = _pairwise_covariance(returns, returns) * 252  # We multiply by 252 to annualize the covariance
+    beta = _pairwise_covariance(returns, market_returns[:, None])[:, 0] / market_variance
+
+    cov_matrix.flags.writeable = False
+    beta.flags.writeable = False
+    return cov_matrix, beta
+
+
+def calculate_group_metrics(portfolio_weights, portfolio_histories, market_history, groups):
+    """
+    Calculates the summed weight, volatility and beta of several groups 
+    of stocks within a portfolio.
+
+    The returns and their covariance matrix are computed once for the 
+    whole portfolio, and each group is reduced from the rows and columns 
+    of its own stocks, rather than rebuilding the covariance per group. 
+    The covariance matrix is memoized on the prices, so a change of 
+    weights alone does not recompute it.
 
     Parameters
     ----------
@@ -63,40 +209,55 @@ def calculate_portfolio_beta(portfolio_weights, portfolio_histories, market_hist
     market_history : dict
         A dictionary containing the historical prices of the
         market (SPY).
+    groups : dict
+        A dictionary containing group names as keys and lists 
+        of the tickers in each group as values.
 
     Returns
     -------
-    float
-        The portfolio beta. Returns np.nan if historical 
-        prices cannot be retrieved or if the portfolio is empty.
-    """ 
-    
+    dict
+        A dictionary containing group names as keys and tuples of 
+        (summed weight, volatility, beta) as values. Volatility and 
+        beta are np.nan for an empty group.
+    """
+
     # Check if the portfolio is empty
     if not portfolio_weights:
-        st.warning("The portfolio is empty. Unable to calculate beta.")
-        return np.nan
+        st.warning("The portfolio is empty. Unable to calculate volatility and beta.")
+        return {name: (0.0, np.nan, np.nan) for name in groups}
 
     # Format the weights and historical prices 
-    weights = np.array(list(portfolio_weights.values()))
-    historical_prices = pd.DataFrame(portfolio_histories).sort_index()
-    market_historical_prices = pd.Series(market_history).sort_index()
-
-    # Calculate the returns
-    returns = historical_prices.pct_change()
-
-    # Calculate the market returns
-    market_returns = market_historical_prices.pct_change()
-
-    # Calculate the covariance of the returns of each stock with the market
-    cov_with_market = returns.apply(lambda x: x.cov(market_returns))
+    tickers = list(portfolio_weights)
+    positions = {ticker: i for i, ticker in enumerate(tickers)}
+    weights = np.fromiter(
+        (portfolio_weights[ticker] for ticker in tickers), dtype=np.float64, count=len(tickers))
+    dates, historical_prices = _price_matrix(portfolio_histories, tickers)
 
-    # Calculate the variance of the market
-    market_variance = market_returns.var()
+    # Calculate the market log returns, aligned with the dates of the 
+    # stock returns, and the variance of the market
+    market_returns_aligned, market_variance = _market_returns(market_history, dates)
 
-    # Calculate the beta for each stock
-    beta = cov_with_market / market_variance
+    # Calculate the covariance matrix and the beta of each stock once, 
+    # reused until the prices change
+    cov_matrix, beta = _return_statistics(
+        historical_prices.tobytes(), market_returns_aligned.tobytes(), 
+        len(tickers), market_variance
+    )
 
-    # Calculate the portfolio beta
-    portfolio_beta = np.sum(weights * beta)
+    # Reduce each group from its own rows and columns
+    metrics = {}
+    for name, group in groups.items():
+        if not group:
+            st.warning(f"The {name} group is empty. Unable to calculate volatility and beta.")
+            metrics[name] = (0.0, np.nan, np.nan)
+            continue
+        index = np.array([positions[ticker] for ticker in group])
+        group_weights = weights[index]
+        group_cov = cov_matrix[np.ix_(index, index)]
+        metrics[name] = (
+            group_weights.sum(),
+            np.sqrt(group_weights @ group_cov @ group_weights),
+            group_weights @ beta[index],
+        )
 
-    return portfolio_beta
\ No newline at end of file
+    return metrics
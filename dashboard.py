@@ -4,34 +4,31 @@ from streamlit_autorefresh import st_autorefresh
 
 from portfolio import Portfolio, update_portfolio, manage_portfolio 
 from display import display_strategy_summary, display_portfolio, display_last_refresh_time
-from api_manager import IBKRApp, IBKRAppSPY
+from api_manager import IBKRApp
 
 
-# Cache portfolio between page refreshes
-@st.cache_data
-def init_portfolio(ttl=None, show_spinner=False):
-    portfolio = Portfolio()
+# Keep the same portfolio between page refreshes. Each browser session 
+# has its own portfolio, as the portfolio is not safe to update from 
+# concurrently running sessions. The cache is reloaded only when another 
+# session has saved new strategies
+def init_portfolio():
+    if 'portfolio' not in st.session_state:
+        st.session_state.portfolio = Portfolio()
+    portfolio = st.session_state.portfolio
     portfolio.load_cache()
     return portfolio
 
-# Cache API instance between page refreshes
+# Cache API instance between page refreshes. A failed connection raises 
+# and is not cached, so the next rerun retries
 @st.cache_resource
 def init_ibkr_app(ttl=None):
     ibkr_app = IBKRApp()
     ibkr_app.start_thread()
-    while not ibkr_app.is_connected:
-        time.sleep(1)
+    if not ibkr_app.connected_event.wait(timeout=10):
+        ibkr_app.stop_thread()
+        raise ConnectionError("Could not connect to TWS/IB Gateway.")
     return ibkr_app
 
-# Cache SPY API instance between page refreshes
-@st.cache_resource
-def init_ibkr_app_spy(ttl=None):
-    ibkr_app_spy = IBKRAppSPY()
-    ibkr_app_spy.start_thread()
-    while not ibkr_app_spy.is_connected:
-        time.sleep(1)
-    return ibkr_app_spy
-
 
 # Dashboard
 if __name__ == '__main__': 
@@ -41,8 +38,11 @@ if __name__ == '__main__':
     portfolio = init_portfolio()
     
     # Instantiate and start the API service
-    ibkr_app = init_ibkr_app()
-    ibkr_app_spy = init_ibkr_app_spy()
+    try:
+        ibkr_app = init_ibkr_app()
+    except ConnectionError as e:
+        ibkr_app = None
+        st.error(f"{e} Retrying...")
 
     # Display messagae if it's the first load
     first_load_placeholder = st.empty()
@@ -53,17 +53,28 @@ if __name__ == '__main__':
         st.session_state.first_load = False
 
     # Check if IBKR connected
-    if ibkr_app.is_connected and ibkr_app_spy.is_connected:
-        # Give some time for apps to start fetching updates
-        time.sleep(20)
+    if ibkr_app is not None and ibkr_app.is_connected:
+        # Wait for the app to receive the portfolio and historical data. 
+        # Once received, later reruns skip the wait entirely
+        if not ibkr_app.ready.is_set():
+            with st.spinner("Waiting for portfolio data..."):
+                ibkr_app.ready.wait(timeout=20)
 
-        # Get holdings and historical data
-        live_holdings = ibkr_app.get_live_portfolio()
-        historical_data = ibkr_app.get_historical_data()
-        historical_data_spy = ibkr_app_spy.get_historical_data()
+        # Get holdings and historical data, if any has been received
+        try:
+            live_holdings = ibkr_app.get_live_portfolio()
+            historical_data = ibkr_app.get_historical_data()
+            historical_data_spy = ibkr_app.get_historical_data_spy()
+        except ValueError:
+            live_holdings, historical_data, historical_data_spy = {}, {}, None
 
-        # Make sure there are holdings before proceeding
-        if live_holdings and historical_data and historical_data_spy:
+        # Make sure there are holdings, and historical data for each held 
+        # stock (zero weights are ignored by the update), before proceeding
+        missing_historical_data = sorted(
+            ticker for ticker, weight in live_holdings.items() 
+            if weight != 0 and ticker not in historical_data
+        )
+        if live_holdings and historical_data_spy and not missing_historical_data:
             # Remove connection message
             first_load_placeholder.empty()
             
@@ -79,9 +90,19 @@ if __name__ == '__main__':
             # Display the current portfolio
             display_strategy_summary(portfolio, historical_data_spy)
 
+        elif live_holdings and missing_historical_data:
+            st.warning(
+                "No historical data received yet for: "
+                f"{', '.join(missing_historical_data)}."
+            )
+
         else:
             st.warning("No portfolio data received yet.")
 
-    # Automatic refresh after a specified amount of time
-    refresh_interval = 25 # seconds
-    st_autorefresh(interval=refresh_interval * 1000)
+    # Automatic refresh after a specified amount of time, held off while 
+    # the user has recently interacted with the strategy sidebar. The 
+    # hold-off only lasts for the rest of the interaction window, so that 
+    # the next refresh restores the regular interval
+    idle_time = time.time() - st.session_state.get('last_interaction', 0)
+    refresh_interval = max(60 - idle_time, 1) if idle_time < 60 else 25 # seconds
+    st_autorefresh(interval=int(refresh_interval * 1000), key='auto_refresh')
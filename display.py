@@ -1,10 +1,58 @@
 import streamlit as st
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 
-from calculations import calculate_portfolio_volatility, calculate_portfolio_beta
+from calculations import calculate_group_metrics
+from portfolio import STRATEGY_OPTIONS
+
+
+# Progress bar colours from red (0%) to green (100%), indexed by whole percent
+COLOR_LUT = tuple(
+    f'rgb({int(255 - i * 2.55)}, {int(i * 2.55)}, 0)' for i in range(101)
+)
+
+# Table styling
+TITLE_STYLE = (
+    'font-size: 18px; font-weight: bold; color: #ffffff; '
+    'border-bottom: 2px solid #f0f0f0; padding-bottom: 5px; '
+    'margin-bottom: 10px;'
+)
+TABLE_STYLE = (
+    'width: 100%; border-collapse: collapse; font-size: 14px; '
+    'border: 1px solid #f0f0f0;'
+)
+TH_STYLE = 'padding: 8px; text-align: left; border-bottom: 1px solid #f0f0f0;'
+TD_STYLE = 'padding: 8px; text-align: left; border-bottom: 1px solid #f0f0f0;'
+WEIGHT_COL_STYLE = 'width: 70%;'
+
+# Table headers and row templates, with the styles already interpolated 
+# so that only the row values are formatted per row
+PORTFOLIO_HEADER = (
+    f'<div style="width: 45%; padding-right: 10px;">'
+    f'<div style="{TITLE_STYLE}">Current Portfolio</div>'
+    f'<table style="{TABLE_STYLE}">'
+    f'<tr><th style="{TH_STYLE}">Ticker</th><th style="{TH_STYLE}">Strategy</th>'
+    f'<th style="{TH_STYLE}{WEIGHT_COL_STYLE}">Weight</th></tr>'
+)
+PORTFOLIO_ROW = (
+    f'<tr><td style="{TD_STYLE}">{{ticker}}</td>'
+    f'<td style="{TD_STYLE}">{{strategy}}</td>'
+    f'<td style="{TD_STYLE}">'
+    f'<div style="width: 100%; background-color: #f0f0f0;">'
+    f'<div style="width: {{pct}}%; height: 10px; background-color: {{color}};"></div></div>'
+    f' {{pct:.2f}}%</td></tr>'
+)
+STRATEGY_HEADER = (
+    f'<div style="width: 60%; padding-right: 10px;">'
+    f'<table style="{TABLE_STYLE}">'
+    f'<tr><th style="{TH_STYLE}">Strategy</th><th style="{TH_STYLE}">Weights</th>'
+    f'<th style="{TH_STYLE}">Volatility</th><th style="{TH_STYLE}">Beta</th></tr>'
+)
+STRATEGY_ROW = (
+    f'<tr><td style="{TD_STYLE}">{{strategy}}</td>'
+    f'<td style="{TD_STYLE}">{{weight:.2f}}</td>'
+    f'<td style="{TD_STYLE}">{{volatility:.2f}}</td>'
+    f'<td style="{TD_STYLE}">{{beta:.2f}}</td></tr>'
+)
+TABLE_FOOTER = '</table></div>'
 
 
 def display_last_refresh_time(portfolio):
@@ -49,57 +97,103 @@ def display_portfolio(portfolio):
         An instance of the Portfolio class representing the current portfolio state.
     """
 
-    stocks = portfolio.get_portfolio()
-    sorted_stocks = sorted(stocks.items(), key=lambda x: x[1]['weight'], reverse=True)
-
-    def get_color(weight):
-        red_value = int(255 - weight * 2.55)
-        green_value = int(weight * 2.55)
-        return f'rgb({red_value}, {green_value}, 0)'
-
-    # Styling
-    title_style = (
-        'font-size: 18px; font-weight: bold; color: #ffffff; '
-        'border-bottom: 2px solid #f0f0f0; padding-bottom: 5px; '
-        'margin-bottom: 10px;'
-    )
-    table_style = (
-        'width: 100%; border-collapse: collapse; font-size: 14px; '
-        'border: 1px solid #f0f0f0;'
-    )
-    th_style = (
-        'padding: 8px; text-align: left; border-bottom: 1px solid #f0f0f0;'
-    )
-    td_style = (
-        'padding: 8px; text-align: left; border-bottom: 1px solid #f0f0f0;'
-    )
-    weight_col_style = 'width: 70%;'
+    sorted_stocks = portfolio.get_stocks_sorted_by_weight()
 
     # HTML Table for portfolio
-    portfolio_table_html = (
-        f'<div style="width: 45%; padding-right: 10px;">'
-        f'<div style="{title_style}">Current Portfolio</div>'
-        f'<table style="{table_style}">'
-        f'<tr><th style="{th_style}">Ticker</th><th style="{th_style}">Strategy</th>'
-        f'<th style="{th_style}{weight_col_style}">Weight</th></tr>'
-    )
-
+    parts = [PORTFOLIO_HEADER]
     for ticker, details in sorted_stocks:
         weight_percentage = details['weight'] * 100
-        progress_bar_color = get_color(weight_percentage)
-        progress_bar = (
-            f'<div style="width: 100%; background-color: #f0f0f0;">'
-            f'<div style="width: {weight_percentage}%; height: 10px; '
-            f'background-color: {progress_bar_color};"></div></div>'
-        )
-        portfolio_table_html += (
-            f'<tr><td style="{td_style}">{ticker}</td>'
-            f'<td style="{td_style}">{details["strategy"]}</td>'
-            f'<td style="{td_style}">{progress_bar} {weight_percentage:.2f}%</td></tr>'
-        )
+        parts.append(PORTFOLIO_ROW.format(
+            ticker=ticker,
+            strategy=details['strategy'],
+            pct=weight_percentage,
+            color=COLOR_LUT[max(0, min(100, int(weight_percentage)))],
+        ))
         
-    portfolio_table_html += '</table></div>'
-    st.markdown(portfolio_table_html, unsafe_allow_html=True)
+    parts.append(TABLE_FOOTER)
+    st.markdown(''.join(parts), unsafe_allow_html=True)
+
+
+def _history_fingerprint(history):
+    """
+    Summarizes a stock's historical data by its length and last bar, 
+    which change whenever new data is received from IBKR.
+
+    Parameters
+    ----------
+    history : dict
+        A dictionary of dates to closing prices.
+
+    Returns
+    -------
+    tuple
+        The number of bars, and the date and price of the last bar.
+    """
+    last_date, last_price = next(reversed(history.items()), (None, None))
+    return len(history), last_date, last_price
+
+
+@st.cache_data(ttl=120, show_spinner=False)
+def _compute_strategy_table(weights_key, strategies_key, historical_key, spy_key,
+                            _portfolio_historical, _spy_history):
+    """
+    Computes the summed weight, volatility and beta of each strategy, the 
+    combined 'Run-up' and 'Hedge' strategies, and the entire portfolio.
+
+    Cached by Streamlit on hashable summaries of the inputs, so reruns 
+    that do not change the portfolio or its data skip the calculations. 
+    The underscore-prefixed arguments are not hashed.
+
+    Parameters
+    ----------
+    weights_key : tuple
+        Sorted (ticker, weight) pairs.
+    strategies_key : tuple
+        Sorted (ticker, strategy) pairs.
+    historical_key : tuple
+        Sorted (ticker, fingerprint) pairs of the historical data.
+    spy_key : tuple
+        Fingerprint of the historical market data.
+    _portfolio_historical : dict
+        The historical data for the portfolio, keyed by ticker.
+    _spy_history : dict
+        The historical market data. Used to calculate beta.
+
+    Returns
+    -------
+    list of list
+        Rows of strategy, summed weight, volatility and beta.
+    """
+    portfolio_weights = dict(weights_key)
+    portfolio_strategies = dict(strategies_key)
+
+    # Group tickers by strategy, in the order of the strategy options. 
+    # Strategies no longer offered (e.g. from an older cache) are 
+    # reported after them
+    strategy_groups = {strategy: [] for strategy in STRATEGY_OPTIONS}
+    for ticker, strategy in portfolio_strategies.items():
+        strategy_groups.setdefault(strategy, []).append(ticker)
+
+    # Strategies without stocks are not reported, Hedge is only reported 
+    # combined with Run-up, and all strategies are reported together as 
+    # the total
+    groups = {
+        strategy: tickers for strategy, tickers in strategy_groups.items()
+        if tickers and strategy != 'Hedge'
+    }
+    combined_strategies = ['Run-up', 'Hedge']
+    groups['Run-up Hedged'] = [
+        ticker for ticker, strategy in portfolio_strategies.items() 
+        if strategy in combined_strategies
+    ]
+    groups['Total'] = list(portfolio_weights)
+
+    # Compute aggregate values of every group from a single covariance matrix
+    metrics = calculate_group_metrics(
+        portfolio_weights, _portfolio_historical, _spy_history, groups)
+    data = [[name, *metrics[name]] for name in groups]
+
+    return data
 
 
 def display_strategy_summary(portfolio, spy_history):
@@ -117,78 +211,24 @@ def display_strategy_summary(portfolio, spy_history):
     portfolio_weights = portfolio.get_weights()
     portfolio_strategies = portfolio.get_strategies()
     portfolio_historical = portfolio.get_historical_data()
-    
-    # Group tickers by strategy
-    strategy_groups = {}
-    for ticker, strategy in portfolio_strategies.items():
-        if strategy not in strategy_groups:
-            strategy_groups[strategy] = []
-        strategy_groups[strategy].append(ticker)
-
-    # Compute aggregate values by strategy
-    data = []
-    for strategy, tickers in strategy_groups.items():
-        if strategy == 'Hedge':
-            pass
-        else:
-            strat_weights = {ticker: portfolio_weights[ticker] for ticker in tickers}
-            summed_weight = np.sum(list(strat_weights.values()))
-            strat_histories = {ticker: portfolio_historical[ticker] for ticker in tickers}
-            volatility = calculate_portfolio_volatility(strat_weights, strat_histories)
-            beta = calculate_portfolio_beta(strat_weights, strat_histories, spy_history)
-            data.append([strategy, summed_weight, volatility, beta])
-
-    # Compute values for the combined 'Run-up' and 'Hedge' strategies
-    combined_strategies = ['Run-up', 'Hedge']
-    combined_weights = {ticker: portfolio_weights[ticker] for ticker, strategy in portfolio_strategies.items() if strategy in combined_strategies}
-    combined_weight = np.sum(list(combined_weights.values()))
-    combined_histories = {ticker: portfolio_historical[ticker] for ticker, strategy in portfolio_strategies.items() if strategy in combined_strategies}
-    combined_volatility = calculate_portfolio_volatility(combined_weights, combined_histories)
-    combined_beta = calculate_portfolio_beta(combined_weights, combined_histories, spy_history)
-    data.append(['Run-up Hedged', combined_weight, combined_volatility, combined_beta])
-
-    # Compute values for the entire portfolio
-    total_weight = np.sum(list(portfolio_weights.values()))
-    total_volatility = calculate_portfolio_volatility(portfolio_weights, portfolio_historical)
-    total_beta = calculate_portfolio_beta(portfolio_weights, portfolio_historical, spy_history)
-    data.append(['Total', total_weight, total_volatility, total_beta])
-    
-    # Convert data to DataFrame for easier manipulation
-    df = pd.DataFrame(data, columns=['Strategy', 'Summed Weights', 'Volatility', 'Beta'])
-
-    # Styling
-    title_style = (
-        'font-size: 18px; font-weight: bold; color: #ffffff; '
-        'border-bottom: 2px solid #f0f0f0; padding-bottom: 5px; '
-        'margin-bottom: 10px;'
-    )
-    table_style = (
-        'width: 100%; border-collapse: collapse; font-size: 14px; '
-        'border: 1px solid #f0f0f0;'
-    )
-    th_style = (
-        'padding: 8px; text-align: left; border-bottom: 1px solid #f0f0f0;'
-    )
-    td_style = (
-        'padding: 8px; text-align: left; border-bottom: 1px solid #f0f0f0;'
-    )
 
-    # HTML Table for the strategy summary
-    strategy_table_html = (
-        f'<div style="width: 60%; padding-right: 10px;">'
-        f'<table style="{table_style}">'
-        f'<tr><th style="{th_style}">Strategy</th><th style="{th_style}">Weights</th>'
-        f'<th style="{th_style}">Volatility</th><th style="{th_style}">Beta</th></tr>'
+    data = _compute_strategy_table(
+        tuple(sorted(portfolio_weights.items())),
+        tuple(sorted(portfolio_strategies.items())),
+        tuple(sorted(
+            (ticker, _history_fingerprint(history)) 
+            for ticker, history in portfolio_historical.items()
+        )),
+        _history_fingerprint(spy_history),
+        portfolio_historical,
+        spy_history,
     )
 
-    for index, row in df.iterrows():
-        strategy_table_html += (
-            f'<tr><td style="{td_style}">{row["Strategy"]}</td>'
-            f'<td style="{td_style}">{row["Summed Weights"]:.2f}</td>'
-            f'<td style="{td_style}">{row["Volatility"]:.2f}</td>'
-            f'<td style="{td_style}">{row["Beta"]:.2f}</td></tr>'
-        )
+    # HTML Table for the strategy summary
+    parts = [STRATEGY_HEADER]
+    for strategy, summed_weight, volatility, beta in data:
+        parts.append(STRATEGY_ROW.format(
+            strategy=strategy, weight=summed_weight, volatility=volatility, beta=beta))
     
-    strategy_table_html += '</table></div>'
-    st.markdown(strategy_table_html, unsafe_allow_html=True)
-
+    parts.append(TABLE_FOOTER)
+    st.markdown(''.join(parts), unsafe_allow_html=True)
@@ -1,11 +1,13 @@
 import os
-import json
+import time
+import orjson
 from datetime import datetime
 import streamlit as st
 from streamlit_extras.no_default_selectbox import selectbox
 
 
 STRATEGY_OPTIONS = ['Run-up', 'Hedge', 'Hold', 'Medium', 'Long']
+CACHE_PATH = 'cache/strategy.json'
 
 
 class Portfolio:
@@ -17,9 +19,16 @@ class Portfolio:
     def __init__(self):
         """Initializes an empty portfolio."""
         self.portfolio = {}
+        self.weights = {}
+        self.strategies = {}
+        self.sorted_tickers = None
+        self.sorted_by_weight = None
         self.historical_data = {} 
         self.last_refresh_time = None
         self.last_cached_time = None
+        self.cache_mtime = None
+        self.dirty = True
+        self.holdings_fingerprint = None
 
     def add_stock(self, ticker, weight, strategy):
         """
@@ -36,6 +45,11 @@ class Portfolio:
             'Run-up', 'Hedge', 'Hold', 'Medium', 'Long').
         """
         self.portfolio[ticker] = {'weight': weight, 'strategy': strategy}
+        self.weights[ticker] = weight
+        self.strategies[ticker] = strategy
+        self.sorted_tickers = None
+        self.sorted_by_weight = None
+        self.dirty = True
 
     def update_stock(self, ticker, weight=None, strategy=None):
         """
@@ -51,10 +65,14 @@ class Portfolio:
             The new strategy associated with the stock (default is None).
         """
         if ticker in self.portfolio:
-            if weight is not None:
+            if weight is not None and weight != self.weights[ticker]:
                 self.portfolio[ticker]['weight'] = weight
-            if strategy is not None:
+                self.weights[ticker] = weight
+                self.sorted_by_weight = None
+            if strategy is not None and strategy != self.strategies[ticker]:
                 self.portfolio[ticker]['strategy'] = strategy
+                self.strategies[ticker] = strategy
+                self.dirty = True
 
     def remove_stock(self, ticker):
         """
@@ -67,9 +85,62 @@ class Portfolio:
         """
         if ticker in self.portfolio:
             del self.portfolio[ticker]
+            del self.weights[ticker]
+            del self.strategies[ticker]
+            self.sorted_tickers = None
+            self.sorted_by_weight = None
+            self.dirty = True
         if ticker in self.historical_data:
             del self.historical_data[ticker]
 
+    def apply_diff(self, added=None, removed=None, updated=None, historical=None):
+        """
+        Applies a batch of changes to the portfolio in a single pass.
+
+        Unlike `add_stock`, `update_stock` and `remove_stock`, the tickers 
+        are not checked against the portfolio, so they must be consistent 
+        with it: added tickers must not be in the portfolio, and removed 
+        or updated tickers must be.
+
+        Parameters
+        ----------
+        added : dict, optional
+            Tickers to add as keys, and (weight, strategy) tuples as values.
+        removed : iterable, optional
+            Tickers to remove, along with their historical data.
+        updated : dict, optional
+            Tickers to update as keys, and their new weights as values.
+        historical : dict, optional
+            Tickers as keys, and their new historical data as values.
+        """
+        added = added or {}
+        removed = removed or ()
+        updated = updated or {}
+
+        for ticker in removed:
+            del self.portfolio[ticker]
+            del self.weights[ticker]
+            del self.strategies[ticker]
+            self.historical_data.pop(ticker, None)
+
+        for ticker, (weight, strategy) in added.items():
+            self.portfolio[ticker] = {'weight': weight, 'strategy': strategy}
+            self.weights[ticker] = weight
+            self.strategies[ticker] = strategy
+
+        for ticker, weight in updated.items():
+            self.portfolio[ticker]['weight'] = weight
+            self.weights[ticker] = weight
+
+        if historical:
+            self.historical_data.update(historical)
+
+        if added or removed:
+            self.sorted_tickers = None
+            self.dirty = True
+        if added or removed or updated:
+            self.sorted_by_weight = None
+
     def set_historical_data(self, ticker, data):
         """
         Set the historical data for a stock.
@@ -91,19 +162,31 @@ class Portfolio:
         -----
         This function will create a cache directory if it does 
         not exist and will save the strategy data in a file named 
-        'strategy.json' within the cache directory.
+        'strategy.json' within the cache directory. The data is written 
+        to a temporary file which then replaces the cache, so an 
+        interrupted write never leaves a truncated cache behind. Nothing 
+        is written unless stocks or strategies have changed since the cache 
+        was last saved or loaded; weights are received from IBKR anyway.
         """
+        if not self.dirty:
+            return
+
         self.last_cached_time = datetime.now()
         
         cache_data = {
             'portfolio': self.portfolio,
-            'last_cached_time': self.last_cached_time.strftime('%Y-%m-%d %H:%M:%S')
+            'last_cached_time': self.last_cached_time
         }
         
         if not os.path.exists('cache'):
             os.makedirs('cache')
-        with open('cache/strategy.json', 'w') as f:
-            json.dump(cache_data, f)
+        with open(CACHE_PATH + '.tmp', 'wb') as f:
+            f.write(orjson.dumps(cache_data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(CACHE_PATH + '.tmp', CACHE_PATH)
+        self.cache_mtime = os.stat(CACHE_PATH).st_mtime_ns
+        self.dirty = False
 
     def load_cache(self):
         """
@@ -113,18 +196,46 @@ class Portfolio:
         -----
         If the file is not found or there is an error in decoding 
         the file, a warning will be displayed to the user, and the 
-        program will proceed without loading the strategies.
+        program will proceed without loading the strategies. If the 
+        file has not been modified since it was last loaded or saved, 
+        it is not read again, so this can be called on every rerun to 
+        pick up strategies saved by other sessions.
         """
         try:
-            with open('cache/strategy.json', 'r') as f:
-                cache_data = json.load(f)
-                self.portfolio = cache_data['portfolio']
-                self.last_cached_time = datetime.strptime(
-                    cache_data['last_cached_time'], '%Y-%m-%d %H:%M:%S')
+            cache_mtime = os.stat(CACHE_PATH).st_mtime_ns
         except FileNotFoundError:
-            st.warning('Cache not found. Starting with a clean slate.')
-        except json.JSONDecodeError:
+            # Only warn the first time, rather than on every rerun
+            if self.cache_mtime is None:
+                st.warning('Cache not found. Starting with a clean slate.')
+                self.cache_mtime = 0
+            return
+        if cache_mtime == self.cache_mtime:
+            return
+
+        # Remember the modification time even if decoding fails, so that 
+        # a broken cache is not read again until it is rewritten
+        self.cache_mtime = cache_mtime
+        try:
+            with open(CACHE_PATH, 'rb') as f:
+                cache_data = orjson.loads(f.read())
+        except orjson.JSONDecodeError:
             st.warning('Error decoding cache. Starting with a clean slate.')
+            return
+
+        self.portfolio = cache_data['portfolio']
+        self.weights = {
+            ticker: data['weight'] for ticker, data in self.portfolio.items()}
+        self.strategies = {
+            ticker: data['strategy'] for ticker, data in self.portfolio.items()}
+        self.sorted_tickers = None
+        self.sorted_by_weight = None
+        self.last_cached_time = datetime.fromisoformat(
+            cache_data['last_cached_time'])
+        self.dirty = False
+
+        # The cached weights and stocks may be stale, so the next update 
+        # must reapply the live holdings
+        self.holdings_fingerprint = None
     
     def get_portfolio(self):
         """
@@ -148,7 +259,7 @@ class Portfolio:
             A dictionary containing the ticker symbols 
             as keys, and corresponding weight as values.
         """
-        return {ticker: data['weight'] for ticker, data in self.portfolio.items()}
+        return self.weights
 
     def get_strategies(self):
         """
@@ -160,7 +271,38 @@ class Portfolio:
             A dictionary containing the ticker symbols 
             as keys, and corresponding strategies as values.
         """
-        return {ticker: data['strategy'] for ticker, data in self.portfolio.items()}
+        return self.strategies
+
+    def get_tickers_sorted(self):
+        """
+        Returns the tickers in the portfolio in alphabetical order. The 
+        order is only recomputed after stocks are added or removed.
+
+        Returns
+        -------
+        list
+            The sorted ticker symbols.
+        """
+        if self.sorted_tickers is None:
+            self.sorted_tickers = sorted(self.portfolio)
+        return self.sorted_tickers
+
+    def get_stocks_sorted_by_weight(self):
+        """
+        Returns the stocks in the portfolio in descending order of weight. 
+        The order is only recomputed after a weight changes or stocks are 
+        added or removed.
+
+        Returns
+        -------
+        list
+            A list of (ticker, details) pairs, where details contains 
+            the weight and strategy of the stock.
+        """
+        if self.sorted_by_weight is None:
+            self.sorted_by_weight = sorted(
+                self.portfolio.items(), key=lambda x: x[1]['weight'], reverse=True)
+        return self.sorted_by_weight
 
     def get_historical_data(self, ticker=None):
         """
@@ -223,23 +365,50 @@ def update_portfolio(portfolio, holdings, historical_data):
         and values are weighting.
     historical_data : dict
         A dictionary containing historical data for stocks.
+
+    Notes
+    -----
+    If neither the holdings nor the historical data of the held stocks 
+    have changed since the last complete update, only the refresh time 
+    is updated. Historical data is replaced (not modified) by the API 
+    when refreshed, so it is compared by identity.
     """
     
     # Record the current time
     portfolio.last_refresh_time = datetime.now()
     
-    # Get tickers of old portfolio and new portfolio
-    old_tickers = set(portfolio.get_portfolio().keys())
+    # Get tickers of new portfolio
     new_tickers = set(ticker for ticker, weight in holdings.items() if weight != 0)
 
-    # Detecting removed stocks (in old but not in new)
+    # Skip the update if nothing has changed since the last complete update
+    fingerprint = (
+        tuple(sorted(holdings.items())),
+        tuple(id(historical_data.get(ticker, None)) for ticker in sorted(new_tickers)),
+    )
+    if fingerprint == portfolio.holdings_fingerprint:
+        return
+
+    # Get tickers of old portfolio
+    old_tickers = set(portfolio.get_portfolio().keys())
+
+    # Detecting removed, new and existing stocks
     removed_tickers = old_tickers - new_tickers
+    added_tickers = new_tickers - old_tickers
+    updated_tickers = {
+        ticker for ticker in new_tickers & old_tickers 
+        if holdings[ticker] != portfolio.weights[ticker]
+    }
+
+    # Remove old stocks, update changed weights and set historical data 
+    # of all held stocks (including new ones awaiting a strategy)
+    portfolio.apply_diff(
+        removed=removed_tickers,
+        updated={ticker: holdings[ticker] for ticker in updated_tickers},
+        historical={ticker: historical_data[ticker] for ticker in new_tickers},
+    )
     for ticker in removed_tickers:
-        portfolio.remove_stock(ticker)
         st.success(f"{ticker} has been removed from the portfolio.")
 
-    # Detecting new stocks (in new but not in old)
-    added_tickers = new_tickers - old_tickers
     if added_tickers:
         # Create a placeholder that will hold the form
         placeholder = st.empty()
@@ -263,9 +432,11 @@ def update_portfolio(portfolio, holdings, historical_data):
             
             # If the button is clicked, update portfolio with selected strategies
             if submit_button:
-                for ticker, strategy in selected_strategies.items():
-                    weight = holdings[ticker]
-                    portfolio.add_stock(ticker, weight, strategy)
+                portfolio.apply_diff(added={
+                    ticker: (holdings[ticker], strategy)
+                    for ticker, strategy in selected_strategies.items()
+                })
+                for ticker in selected_strategies:
                     st.success(f"Strategy for {ticker} has been successfully submitted.")
                 
                 # Save the strategies to cache
@@ -274,15 +445,20 @@ def update_portfolio(portfolio, holdings, historical_data):
                 # Remove the prompt from the screen once strategies have been submitted
                 placeholder.empty()            
 
-        # Update historical data for new stocks
-        for ticker in added_tickers:
-            portfolio.set_historical_data(ticker, historical_data[ticker])
+    # Remember the inputs once every held stock has a strategy, so that 
+    # a pending strategy prompt keeps being displayed until submitted
+    if new_tickers == set(portfolio.get_portfolio().keys()):
+        portfolio.holdings_fingerprint = fingerprint
+    else:
+        portfolio.holdings_fingerprint = None
+
 
-    # Updating existing stocks (intersection of old and new)
-    for ticker in new_tickers & old_tickers:
-        weight = holdings[ticker]
-        portfolio.update_stock(ticker, weight)
-        portfolio.set_historical_data(ticker, historical_data[ticker])
+def record_interaction():
+    """
+    Records the time of the user's latest interaction with the strategy 
+    sidebar, so that automatic refreshes can be held off meanwhile.
+    """
+    st.session_state.last_interaction = time.time()
 
 
 def manage_portfolio(portfolio):
@@ -304,13 +480,14 @@ def manage_portfolio(portfolio):
 
     # Get stocks and sort them alphabetically by ticker
     stocks = portfolio.get_portfolio()
-    sorted_tickers = sorted(stocks.keys())
+    sorted_tickers = portfolio.get_tickers_sorted()
 
     # Selectbox for choosing a ticker
     selected_ticker = st.sidebar.selectbox(
         'Select ticker to update strategy:',
         sorted_tickers,
-        help='Choose a stock from the portfolio to manage.'
+        help='Choose a stock from the portfolio to manage.',
+        on_change=record_interaction
     )
 
     if selected_ticker:
@@ -322,11 +499,12 @@ def manage_portfolio(portfolio):
             'Choose a new strategy:',
             STRATEGY_OPTIONS,
             index=STRATEGY_OPTIONS.index(current_strategy),
-            help='Select a new strategy from the dropdown.'
+            help='Select a new strategy from the dropdown.',
+            on_change=record_interaction
         )
 
         # Confirmation button to update strategy
-        if st.sidebar.button('Update Strategy'):
+        if st.sidebar.button('Update Strategy', on_click=record_interaction):
             portfolio.update_stock(selected_ticker, strategy=new_strategy)
             st.sidebar.success(
                 f"{selected_ticker} strategy updated to {new_strategy}."